@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+fuente_sensor.py
+
+Fuentes de datos ambientales para los bloques de qr_sim_blockchain.py.
+
+ - FuenteSensor: interfaz común. lectura() nunca bloquea: devuelve lo último
+   que haya en memoria (o una interpolación) y metricas() expone antigüedad
+   y latencia de lectura.
+ - FuenteSimulada: valores aleatorios (generar_datos_simulados), la opción por defecto.
+ - FuenteSerialBME680: hilo en segundo plano que interpreta el texto que
+   imprime ProyectoFinal/BMEPRYECTO/BMEPRYECTO.ino por el puerto serie:
+
+       Temperatura = 23.41 °C
+       Presión = 1012.35 hPa
+       Humedad = 41.20 %
+       Gas = 12.34 KOhms
+       <línea vacía>
+
+   y guarda cada lectura con su marca de tiempo en un búfer circular.
+   El origen puede ser un puerto real (pyserial), un pty o un archivo de
+   repetición grabado con la salida del ESP32.
+
+Especificación para crear_fuente():
+  simulado               datos aleatorios de generar_datos_simulados
+  serial:/dev/ttyUSB0    puerto serie (pyserial si está instalado; si no, se abre como archivo)
+  replay:bme680.txt      archivo grabado, reproducido al ritmo del sketch (2 s por lectura)
+
+Dependencias opcionales:
+  pip3 install pyserial
+"""
+
+import os
+import re
+import time
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+
+try:
+    import serial  # pyserial, solo necesario para puertos serie reales
+except ImportError:
+    serial = None
+
+# Prefijo de línea del sketch -> campo del registro
+CAMPOS_BME680 = (
+    ('Temperatura', 'temperatura_C'),
+    ('Presi', 'presion_hPa'),  # "Presión" puede llegar con la ó mal codificada
+    ('Humedad', 'humedad_%'),
+    ('Gas', 'gas_kOhm'),
+)
+_NUMERO = re.compile(r'=\s*(-?\d+(?:\.\d+)?)')
+
+# ----------------- Interfaz -----------------
+
+class FuenteSensor(ABC):
+    """Interfaz de una fuente de datos ambientales."""
+
+    def iniciar(self):
+        pass
+
+    def detener(self):
+        pass
+
+    @abstractmethod
+    def lectura(self, t: float = None) -> dict:
+        """Campos para agregar al registro, para el instante t (time.time())."""
+
+    def metricas(self) -> dict:
+        return {}
+
+def parsear_ubicacion(texto: str) -> tuple:
+    """'LAT,LON' -> (lat, lon); ValueError si no son dos números."""
+    lat, lon = (float(v) for v in texto.split(','))
+    return lat, lon
+
+# ----------------- Simulada -----------------
+
+class FuenteSimulada(FuenteSensor):
+    """
+    Datos aleatorios de generador() -> (temp, hum, lat, lon), normalmente
+    generar_datos_simulados de qr_sim_blockchain.py.
+    """
+
+    def __init__(self, generador, ubicacion: tuple = None):
+        self.generador = generador
+        self.ubicacion = ubicacion
+        self.lecturas = 0
+
+    def lectura(self, t: float = None) -> dict:
+        temp, hum, lat, lon = self.generador()
+        if self.ubicacion is not None:
+            lat, lon = self.ubicacion
+        self.lecturas += 1
+        return {'temperatura_C': temp, 'humedad_%': hum, 'lat': lat, 'lon': lon}
+
+    def metricas(self) -> dict:
+        return {'fuente': 'simulado', 'lecturas': self.lecturas}
+
+# ----------------- BME680 por puerto serie -----------------
+
+class FuenteSerialBME680(FuenteSensor):
+    def __init__(self, origen: str, es_replay: bool = False, baudios: int = 115200,
+                 capacidad: int = 256, ritmo_replay: float = 2.0, repetir: bool = True,
+                 ubicacion: tuple = None):
+        self.origen = origen
+        self.es_replay = es_replay
+        self.baudios = baudios
+        self.ritmo_replay = ritmo_replay
+        self.repetir = repetir
+        self.ubicacion = ubicacion
+        self._buffer = deque(maxlen=capacidad)  # dicts con 't' (time.time()) y los campos
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        self.lecturas = 0
+        self.errores = 0
+        self.caido = False  # True desde que el origen falla hasta la siguiente lectura completa
+        self.latencias_ms = deque(maxlen=100)  # primera línea -> lectura completa
+
+    def iniciar(self):
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._leer_continuo, daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=2)
+            self._hilo = None
+
+    def _abrir(self):
+        if not self.es_replay and serial is not None:
+            return serial.Serial(self.origen, self.baudios, timeout=1)
+        # pty, dispositivo ya configurado con stty o archivo de repetición
+        return open(self.origen, 'rb', buffering=0)
+
+    def _leer_continuo(self):
+        espera = 1.0
+        while not self._detener.is_set():
+            try:
+                with self._abrir() as puerto:
+                    self._consumir(puerto)
+            except OSError as e:
+                self.errores += 1
+                # Un aviso por corte; los reintentos siguientes solo suman errores
+                if not self.caido:
+                    print('Aviso: fuente de sensor no disponible (se reintentará):', e)
+                    self.caido = True
+            if self.es_replay and not self.repetir:
+                break
+            # Reintentos cada vez más espaciados mientras el origen siga caído
+            espera = min(espera * 2, 30.0) if self.caido else 1.0
+            self._detener.wait(espera)
+
+    def _consumir(self, puerto):
+        parcial, t_primera = {}, None
+        while not self._detener.is_set():
+            linea = puerto.readline()
+            if not linea:
+                if self.es_replay:
+                    return  # fin del archivo
+                # Timeout de pyserial, o EOF de un tty abierto como archivo:
+                # esperar un poco en lugar de girar al 100% de CPU
+                self._detener.wait(0.05)
+                continue
+            texto = linea.decode('utf-8', errors='replace').strip()
+
+            if not texto:
+                # Línea vacía: fin de un bloque del sketch. Un tty sin pyserial
+                # (ICRNL) convierte cada \r\n en dos saltos, así que una línea
+                # vacía con el bloque incompleto se ignora en vez de descartarlo.
+                if 'temperatura_C' in parcial and 'humedad_%' in parcial:
+                    self._guardar(parcial, t_primera)
+                    parcial, t_primera = {}, None
+                    if self.es_replay:
+                        self._detener.wait(self.ritmo_replay)
+                continue
+            if texto.startswith('Error'):
+                self.errores += 1
+                parcial, t_primera = {}, None
+                continue
+
+            for prefijo, campo in CAMPOS_BME680:
+                if texto.startswith(prefijo):
+                    m = _NUMERO.search(texto)
+                    if m:
+                        if t_primera is None:
+                            t_primera = time.perf_counter()
+                        parcial[campo] = float(m.group(1))
+                    break
+
+    def _guardar(self, campos: dict, t_primera: float):
+        lectura = dict(campos)
+        lectura['t'] = time.time()
+        with self._lock:
+            self._buffer.append(lectura)
+            self.lecturas += 1
+            self.caido = False
+            self.latencias_ms.append((time.perf_counter() - t_primera) * 1000)
+
+    def lectura(self, t: float = None) -> dict:
+        """
+        Lectura para el instante t sin esperar al puerto: interpolada entre
+        las dos lecturas que lo rodean, o la más reciente si t es posterior.
+        """
+        t = time.time() if t is None else t
+        with self._lock:
+            buffer = list(self._buffer)
+        if not buffer:
+            resultado = {'temperatura_C': None, 'humedad_%': None, 'sensor': 'bme680_sin_lectura'}
+        else:
+            resultado = self._interpolar(buffer, t)
+        if self.ubicacion is not None:
+            resultado['lat'], resultado['lon'] = self.ubicacion
+        return resultado
+
+    @staticmethod
+    def _interpolar(buffer: list, t: float) -> dict:
+        ultima = buffer[-1]
+        if t >= ultima['t'] or len(buffer) == 1:
+            base, interpolada = ultima, False
+        elif t <= buffer[0]['t']:
+            base, interpolada = buffer[0], False
+        else:
+            # Búsqueda desde el final: t casi siempre cae cerca de lo más reciente
+            i = len(buffer) - 1
+            while buffer[i - 1]['t'] > t:
+                i -= 1
+            a, b = buffer[i - 1], buffer[i]
+            f = (t - a['t']) / (b['t'] - a['t'])
+            base = {campo: round(a[campo] + (b[campo] - a[campo]) * f, 2)
+                    for campo in a if campo != 't' and campo in b}
+            base['t'] = b['t']
+            interpolada = True
+        resultado = {campo: v for campo, v in base.items() if campo != 't'}
+        resultado['sensor'] = 'bme680'
+        resultado['sensor_interpolado'] = interpolada
+        resultado['sensor_edad_s'] = round(max(0.0, t - base['t']), 3)
+        return resultado
+
+    def metricas(self) -> dict:
+        with self._lock:
+            ultima_t = self._buffer[-1]['t'] if self._buffer else None
+            latencias = sorted(self.latencias_ms)
+        return {
+            'lecturas': self.lecturas,
+            'errores': self.errores,
+            'disponible': not self.caido,
+            'edad_s': round(time.time() - ultima_t, 3) if ultima_t is not None else None,
+            'latencia_lectura_ms_p50': round(latencias[len(latencias) // 2], 1) if latencias else None,
+            'latencia_lectura_ms_max': round(latencias[-1], 1) if latencias else None,
+        }
+
+# ----------------- Fábrica -----------------
+
+def crear_fuente(spec: str, simulador, ubicacion: tuple = None) -> FuenteSensor:
+    """
+    Devuelve una FuenteSensor ya iniciada. simulador es la función de datos
+    aleatorios usada por 'simulado' (generar_datos_simulados).
+    """
+    tipo, _, origen = (spec or 'simulado').partition(':')
+    if tipo == 'simulado' and not origen:
+        fuente = FuenteSimulada(simulador, ubicacion=ubicacion)
+    elif tipo == 'serial' and origen:
+        fuente = FuenteSerialBME680(origen, ubicacion=ubicacion)
+    elif tipo == 'replay' and origen:
+        if not os.path.isfile(origen):
+            raise ValueError(f'No existe el archivo de repetición: {origen}')
+        fuente = FuenteSerialBME680(origen, es_replay=True, ubicacion=ubicacion)
+    else:
+        raise ValueError(f'Fuente de sensor desconocida "{spec}" (simulado, serial:PUERTO, replay:ARCHIVO)')
+    fuente.iniciar()
+    return fuente
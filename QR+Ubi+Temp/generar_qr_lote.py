@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+generar_qr_lote.py
+
+Generación masiva de etiquetas QR firmadas (mismo formato que generar_qr.py:
+base64url(payload_json).base64url(hmac_sha256(payload_json, SECRET_KEY))).
+
+ - Lee filas SKU/serial de un CSV o de un rango (SKU:INICIO-FIN)
+ - Firma en el proceso principal reutilizando el estado HMAC ya inicializado con la clave
+ - Dibuja los PNG en paralelo con un pool de procesos
+ - Escribe todo en un único .zip o en hojas de impresión en mosaico (PNG)
+ - Reporta etiquetas/s y permite reanudar: lo que ya está en el .zip
+   o las hojas ya escritas no se vuelven a generar
+
+Uso:
+  python3 generar_qr_lote.py --range ABC123:0001-5000 --out etiquetas.zip
+  python3 generar_qr_lote.py --csv seriales.csv --out etiquetas.zip --workers 8
+  python3 generar_qr_lote.py --range ABC123:1-600 --sheets 6x8 --out hojas/
+
+  El CSV necesita columnas sku y serial; batch e issuer son opcionales
+  (si faltan se usan --batch y --issuer).
+
+Dependencias:
+  pip3 install "qrcode[pil]"
+"""
+
+import os
+import io
+import csv
+import sys
+import json
+import time
+import hmac
+import base64
+import hashlib
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import qrcode
+
+# Clave por defecto (solo para pruebas), la misma de qr_sim_blockchain.py
+DEFAULT_SECRET = b"mi_clave_secreta_32bytes"
+
+# ----------------- Filas de entrada -----------------
+
+def filas_desde_csv(path: str, batch: str, issuer: str):
+    with open(path, newline='', encoding='utf-8') as f:
+        lector = csv.DictReader(f)
+        for fila in lector:
+            sku, serial = (fila.get('sku') or '').strip(), (fila.get('serial') or '').strip()
+            if not sku or not serial:
+                raise ValueError(f'{path}, línea {lector.line_num}: faltan sku y/o serial')
+            yield {
+                'sku': sku,
+                'serial': serial,
+                'batch': (fila.get('batch') or batch).strip(),
+                'issuer': (fila.get('issuer') or issuer).strip()
+            }
+
+def filas_desde_rango(spec: str, batch: str, issuer: str):
+    """SKU:INICIO-FIN; el ancho de INICIO fija el relleno con ceros (0001-5000)."""
+    try:
+        sku, rango = spec.rsplit(':', 1)
+        inicio, fin = rango.split('-', 1)
+        a, b = int(inicio), int(fin)
+    except ValueError:
+        raise ValueError(f'Rango inválido "{spec}", se espera SKU:INICIO-FIN')
+    ancho = len(inicio) if inicio.startswith('0') else 0
+    for n in range(a, b + 1):
+        yield {'sku': sku, 'serial': str(n).zfill(ancho), 'batch': batch, 'issuer': issuer}
+
+# ----------------- Firma -----------------
+
+def b64url_encode(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).decode('utf-8').rstrip('=')
+
+class Firmador:
+    """HMAC-SHA256 con la clave ya procesada: cada firma parte de una copia del estado."""
+
+    def __init__(self, secret_key: bytes):
+        self._base = hmac.new(secret_key, digestmod=hashlib.sha256)
+
+    def qr_text(self, payload: dict) -> str:
+        payload_json = json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        h = self._base.copy()
+        h.update(payload_json)
+        return f"{b64url_encode(payload_json)}.{b64url_encode(h.digest())}"
+
+def nombre_etiqueta(fila: dict) -> str:
+    return f"{fila['sku']}_{fila['serial']}.png"
+
+# ----------------- Render (procesos del pool) -----------------
+
+def _png(qr_text: str) -> bytes:
+    buf = io.BytesIO()
+    qrcode.make(qr_text).save(buf)
+    return buf.getvalue()
+
+def _render_etiquetas(trabajo: list) -> list:
+    """[(nombre, qr_text)] -> [(nombre, png_bytes)]"""
+    return [(nombre, _png(qr_text)) for nombre, qr_text in trabajo]
+
+def _render_hoja(args) -> tuple:
+    """(nombre_hoja, cols, filas, [(rotulo, qr_text)]) -> (nombre_hoja, png_bytes, n)"""
+    from PIL import Image, ImageDraw
+    nombre, cols, filas, trabajo = args
+    imagenes = [(rotulo, Image.open(io.BytesIO(_png(qr_text))).convert('L')) for rotulo, qr_text in trabajo]
+    lado = max(img.size[0] for _, img in imagenes)
+    alto_rotulo = 16
+    hoja = Image.new('L', (cols * lado, filas * (lado + alto_rotulo)), 255)
+    dibujo = ImageDraw.Draw(hoja)
+    for i, (rotulo, img) in enumerate(imagenes):
+        x, y = (i % cols) * lado, (i // cols) * (lado + alto_rotulo)
+        hoja.paste(img, (x, y))
+        dibujo.text((x + 4, y + lado), rotulo, fill=0)
+    buf = io.BytesIO()
+    hoja.save(buf, format='PNG')
+    return nombre, buf.getvalue(), len(trabajo)
+
+# ----------------- Salidas -----------------
+
+class Progreso:
+    def __init__(self, total: int):
+        self.total = total
+        self.hechas = 0
+        self.inicio = time.perf_counter()
+
+    def avanzar(self, n: int):
+        self.hechas += n
+        dt = time.perf_counter() - self.inicio
+        print(f'\r{self.hechas}/{self.total} etiquetas  {self.hechas / dt if dt else 0:.0f} etiquetas/s', end='', flush=True)
+
+    def fin(self):
+        dt = time.perf_counter() - self.inicio
+        print(f'\nListo: {self.hechas} etiquetas en {dt:.2f}s ({self.hechas / dt if dt else 0:.0f} etiquetas/s)')
+
+def generar_zip(filas: list, firmador: Firmador, out: str, workers: int, tam_trabajo: int):
+    hechas = set()
+    if os.path.exists(out):
+        try:
+            with zipfile.ZipFile(out) as zf:
+                hechas = set(zf.namelist())
+        except zipfile.BadZipFile:
+            sys.exit(f'{out} está dañado (se interrumpió mientras se escribía una etiqueta). '
+                     f'Renómbralo o bórralo y vuelve a ejecutar para generar el archivo completo.')
+    pendientes = [(nombre_etiqueta(f), f) for f in filas if nombre_etiqueta(f) not in hechas]
+    if hechas:
+        print(f'Reanudando: {len(filas) - len(pendientes)} etiquetas ya estaban en {out}')
+    trabajos = [
+        [(nombre, firmador.qr_text(f)) for nombre, f in pendientes[i:i + tam_trabajo]]
+        for i in range(0, len(pendientes), tam_trabajo)
+    ]
+    progreso = Progreso(len(pendientes))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futuros = [ex.submit(_render_etiquetas, t) for t in trabajos]
+        for fut in as_completed(futuros):
+            etiquetas = fut.result()
+            # Abrir/cerrar por trabajo deja el .zip válido entre trabajos; una
+            # interrupción dentro de writestr sí lo daña (ver arriba)
+            with zipfile.ZipFile(out, 'a', compression=zipfile.ZIP_STORED) as zf:
+                for nombre, png in etiquetas:
+                    zf.writestr(nombre, png)
+            progreso.avanzar(len(etiquetas))
+    progreso.fin()
+
+def generar_hojas(filas: list, firmador: Firmador, out_dir: str, cols: int, filas_hoja: int, workers: int):
+    os.makedirs(out_dir, exist_ok=True)
+    por_hoja = cols * filas_hoja
+    trabajos = []
+    for n, i in enumerate(range(0, len(filas), por_hoja), start=1):
+        nombre = os.path.join(out_dir, f'hoja_{n:05d}.png')
+        if os.path.exists(nombre):
+            continue
+        trabajo = [(f"{f['sku']} {f['serial']}", firmador.qr_text(f)) for f in filas[i:i + por_hoja]]
+        trabajos.append((nombre, cols, filas_hoja, trabajo))
+    saltadas = -(-len(filas) // por_hoja) - len(trabajos)
+    if saltadas:
+        print(f'Reanudando: {saltadas} hojas ya existían en {out_dir}')
+    progreso = Progreso(sum(len(t[3]) for t in trabajos))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for fut in as_completed([ex.submit(_render_hoja, t) for t in trabajos]):
+            nombre, png, n = fut.result()
+            # Escritura atómica: una hoja a medias nunca se toma como terminada
+            with open(nombre + '.tmp', 'wb') as f:
+                f.write(png)
+            os.replace(nombre + '.tmp', nombre)
+            progreso.avanzar(n)
+    progreso.fin()
+
+# ----------------- CLI -----------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generacion masiva de etiquetas QR firmadas (HMAC-SHA256)')
+    origen = parser.add_mutually_exclusive_group(required=True)
+    origen.add_argument('--csv', type=str, help='CSV con columnas sku,serial[,batch,issuer]')
+    origen.add_argument('--range', type=str, help='Rango SKU:INICIO-FIN (ej. ABC123:0001-5000)')
+    parser.add_argument('--batch', type=str, default='2025-11-01', help='Lote por defecto')
+    parser.add_argument('--issuer', type=str, default='FABRICA_X', help='Emisor por defecto')
+    parser.add_argument('--out', type=str, required=True, help='Archivo .zip o carpeta de hojas (con --sheets)')
+    parser.add_argument('--sheets', type=str, default=None, help='Hojas en mosaico COLSxFILAS (ej. 6x8)')
+    parser.add_argument('--workers', type=int, default=None, help='Procesos de render (por defecto: nucleos)')
+    parser.add_argument('--chunk', type=int, default=200, help='Etiquetas por trabajo enviado al pool (modo .zip)')
+    parser.add_argument('--secret', type=str, default=None, help='Clave HMAC en texto (reemplaza la default)')
+    args = parser.parse_args(argv)
+
+    if args.chunk < 1:
+        parser.error('--chunk debe ser al menos 1')
+
+    secret_key = DEFAULT_SECRET if args.secret is None else args.secret.encode('utf-8')
+    try:
+        if args.csv:
+            filas = list(filas_desde_csv(args.csv, args.batch, args.issuer))
+        else:
+            filas = list(filas_desde_rango(args.range, args.batch, args.issuer))
+    except (ValueError, KeyError) as e:
+        parser.error(f'Entrada inválida: {e}')
+    print(f'{len(filas)} etiquetas a generar')
+
+    firmador = Firmador(secret_key)
+    if args.sheets:
+        try:
+            cols, filas_hoja = (int(v) for v in args.sheets.lower().split('x'))
+        except ValueError:
+            cols = filas_hoja = 0
+        if cols <= 0 or filas_hoja <= 0:
+            parser.error('--sheets espera COLSxFILAS positivos (ej. 6x8)')
+        try:
+            import PIL  # noqa: F401  (las hojas se componen con Pillow)
+        except ImportError:
+            parser.error('--sheets requiere Pillow: pip3 install "qrcode[pil]"')
+        generar_hojas(filas, firmador, args.out, cols, filas_hoja, args.workers)
+    else:
+        generar_zip(filas, firmador, args.out, args.workers, args.chunk)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('\nInterrumpido; vuelve a ejecutar el mismo comando para reanudar.')
+        sys.exit(1)
@@ -21,6 +21,26 @@ Uso:
       --timeout N    tiempo de espera en segundos para detectar QR (por defecto 60)
       --secret KEY   clave HMAC en texto (si no se especifica, se usa la incluida)
       --camera IDX   índice de la cámara
+      --roi X,Y,W,H  decodificar solo esa región del frame (respaldo: frame completo)
+      --scale F      reducir el frame por F antes de decodificar (ej. 0.5)
+      --multi        registrar todos los QR de cada frame (banda transportadora)
+      --dedup S      segundos en que un QR repetido se ignora (por defecto 3)
+      --cache-ttl S  segundos en que se reutiliza la verificación HMAC (por defecto 300)
+      --sensor SPEC  origen de temperatura/humedad: simulado (defecto), serial:/dev/ttyUSB0
+                     o replay:archivo.txt con la salida de BMEPRYECTO.ino (ver fuente_sensor.py)
+      --ubicacion LAT,LON  coordenadas fijas del escáner (si no, se simulan)
+
+  - Auditar la cadena (enlace prev_hash + recálculo de hash de cada bloque):
+      python3 qr_blockchain_full.py --verify [--workers N] [--full]
+
+  - Agrupar lecturas en un solo bloque con raíz Merkle (alto flujo de QR):
+      python3 qr_blockchain_full.py --batch-size 50 --batch-window 5
+  - Prueba de inclusión de la lectura POS dentro del bloque INDEX:
+      python3 qr_blockchain_full.py --prove INDEX POS
+
+  - Consultar eventos por campos del payload y/o rango de tiempo (índice SQLite):
+      python3 qr_blockchain_full.py --query sku=ABC123 serial=0001 --desde 2025-11-05 --hasta 2025-11-07
+      python3 qr_blockchain_full.py --reindex      # reconstruir el índice desde chain.json
 
 Dependencias:
   sudo apt install python3-opencv libzbar0 -y    # (Debian/Ubuntu) si falta
@@ -43,11 +63,22 @@ import argparse
 import hashlib
 import base64
 import hmac
+import queue
+import threading
+import sqlite3
+from contextlib import closing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pyzbar import pyzbar
 import qrcode
+from fuente_sensor import FuenteSimulada, crear_fuente, parsear_ubicacion
 
 CHAIN_FILE = "chain.json"
+CHECKPOINT_FILE = "chain.checkpoint.json"
+INDEX_FILE = "chain_index.sqlite"
+# Campos de qr_payload con índice secundario (además del timestamp)
+CAMPOS_INDICE = ('sku', 'serial', 'batch', 'issuer')
 # Clave por defecto (solo para pruebas). En produccion usar variable de entorno o archivo seguro.
 DEFAULT_SECRET = b"mi_clave_secreta_32bytes"
 
@@ -109,45 +140,197 @@ def generar_qr_next_from_hash(prev_hash: str, secret_key: bytes, index: int, out
 
 # ----------------- Lectura de QR por cámara -----------------
 
-def leer_qr_camera(timeout_seconds: int = 60, camera_index: int = 0):
-    cam = cv2.VideoCapture(camera_index)
-    if not cam.isOpened():
-        print("Error: No se pudo abrir la cámara. Verifica el ", camera_index)
-        return None
-
-    inicio = time.time()
-    print('Abriendo cámara... apunta un QR (ESC para salir)')
-
-    resultado = None
-    while True:
-        ret, frame = cam.read()
-        if not ret:
-            print('No se pudo leer frame de la cámara.')
-            break
+class SesionEscaner:
+    """
+    Mantiene la cámara abierta entre lecturas. El hilo principal captura y
+    muestra frames; un hilo trabajador decodifica el frame más reciente en
+    escala de grises, recortado a roi=(x, y, w, h) y/o reducido por escala,
+    y si ahí no encuentra nada reintenta sobre el frame completo.
+    """
 
-        codigos = pyzbar.decode(frame)
-        for c in codigos:
+    def __init__(self, camera_index: int = 0, roi=None, escala: float = 1.0, mostrar: bool = True):
+        self.camera_index = camera_index
+        self.roi = roi
+        self.escala = escala
+        self.mostrar = mostrar
+        self.cam = None
+        self.respaldos = 0  # decodificaciones que necesitaron resolución completa
+        self.reconexiones = 0
+        self._fallos_lectura = 0  # lecturas fallidas seguidas (cámara desconectada)
+        self.latencias_ms = deque(maxlen=500)
+        self._cond = threading.Condition()
+        self._frame = None
+        self._t_frame = None
+        self._resultados = queue.Queue()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def abrir(self) -> bool:
+        self.cam = cv2.VideoCapture(self.camera_index)
+        if not self.cam.isOpened():
+            print("Error: No se pudo abrir la cámara. Verifica el ", self.camera_index)
+            self.cam = None
+            return False
+        # Sin búfer acumulado: tras una pausa el primer frame debe ser actual
+        self.cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._trabajador, daemon=True)
+        self._hilo.start()
+        print('Cámara abierta para toda la sesión (ESC en la ventana cancela la lectura actual)')
+        return True
+
+    def _reabrir_camara(self, espera_max: float):
+        """Tras un cam.read() fallido: esperar (backoff creciente) y volver a abrir la captura."""
+        if self._fallos_lectura == 0:
+            print('No se pudo leer frame de la cámara; reintentando...')
+        self._fallos_lectura += 1
+        time.sleep(max(0.0, min(espera_max, 2.0, 0.1 * 2 ** (self._fallos_lectura - 1))))
+        self.cam.release()
+        self.cam = cv2.VideoCapture(self.camera_index)
+        if self.cam.isOpened():
+            self.cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.reconexiones += 1
+
+    def cerrar(self):
+        self._detener.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._hilo is not None:
+            self._hilo.join(timeout=2)
+            self._hilo = None
+        if self.cam is not None:
+            self.cam.release()
+            self.cam = None
+        if self.mostrar:
+            cv2.destroyAllWindows()
+
+    def __enter__(self):
+        self.abrir()
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+    def _decodificar(self, frame):
+        gris = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        reducido = gris
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            recorte = reducido[y:y + h, x:x + w]
+            # Una ROI fuera del frame deja un recorte vacío: usar el frame entero
+            if recorte.size:
+                reducido = recorte
+        if self.escala != 1.0:
+            reducido = cv2.resize(reducido, None, fx=self.escala, fy=self.escala, interpolation=cv2.INTER_AREA)
+        codigos = pyzbar.decode(reducido)
+        if not codigos and reducido is not gris:
+            self.respaldos += 1
+            codigos = pyzbar.decode(gris)
+        return codigos
+
+    def _trabajador(self):
+        while not self._detener.is_set():
+            with self._cond:
+                while self._frame is None and not self._detener.is_set():
+                    self._cond.wait(0.1)
+                frame, t_captura = self._frame, self._t_frame
+                self._frame = None
+            if frame is None:
+                continue
             try:
-                data = c.data.decode('utf-8')
-            except Exception:
-                data = c.data
-            print('\nQR detectado:')
-            print(data)
-            resultado = data
-            break
-
-        cv2.imshow('Escaneo QR - presiona ESC para salir', frame)
-        if cv2.waitKey(1) == 27:  # ESC
-            break
-        if resultado is not None:
-            break
-        if time.time() - inicio > timeout_seconds:
-            print(f'Tiempo de espera ({timeout_seconds}s) agotado sin detectar QR.')
-            break
+                codigos = self._decodificar(frame)
+            except Exception as e:
+                # Un frame problemático no debe terminar el hilo
+                print('Aviso: no se pudo decodificar el frame:', e)
+                continue
+            textos = []
+            for c in codigos:
+                try:
+                    textos.append(c.data.decode('utf-8'))
+                except Exception:
+                    textos.append(c.data)
+            if textos:
+                self._resultados.put((textos, t_captura))
+
+    def leer_todos(self, timeout_seconds: float = 60):
+        """
+        Espera un frame con al menos un QR. Devuelve (textos, t_captura) con
+        todos los códigos del frame y t_captura en reloj time.perf_counter(),
+        o ([], None) si se agota el tiempo o se cancela.
+        """
+        if self.cam is None:
+            return [], None
+        # Descartar frames y detecciones anteriores a esta lectura; un resultado
+        # de un frame viejo que el trabajador aún esté decodificando se filtra
+        # abajo por su t_captura
+        t_inicio = time.perf_counter()
+        with self._cond:
+            self._frame = None
+        while not self._resultados.empty():
+            self._resultados.get_nowait()
+
+        inicio = time.time()
+        while True:
+            ret, frame = self.cam.read()
+            if not ret:
+                restante = timeout_seconds - (time.time() - inicio)
+                if restante <= 0:
+                    print(f'Tiempo de espera ({timeout_seconds}s) agotado sin frames de la cámara.')
+                    return [], None
+                self._reabrir_camara(restante)
+                continue
+            if self._fallos_lectura:
+                print('Cámara recuperada.')
+                self._fallos_lectura = 0
+            with self._cond:
+                self._frame, self._t_frame = frame, time.perf_counter()
+                self._cond.notify()
+
+            if self.mostrar:
+                cv2.imshow('Escaneo QR - presiona ESC para salir', frame)
+                if cv2.waitKey(1) == 27:  # ESC
+                    return [], None
+            try:
+                textos, t_captura = self._resultados.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                if t_captura >= t_inicio:
+                    return textos, t_captura
+            if time.time() - inicio > timeout_seconds:
+                print(f'Tiempo de espera ({timeout_seconds}s) agotado sin detectar QR.')
+                return [], None
+
+    def leer(self, timeout_seconds: float = 60):
+        """Como leer_todos pero solo el primer QR: (texto, t_captura) o (None, None)."""
+        textos, t_captura = self.leer_todos(timeout_seconds)
+        if not textos:
+            return None, None
+        print('\nQR detectado:')
+        print(textos[0])
+        return textos[0], t_captura
+
+    def registrar_latencia(self, t_captura: float) -> float:
+        """Latencia escaneo -> registro en ms (desde el frame hasta ahora)."""
+        ms = (time.perf_counter() - t_captura) * 1000
+        self.latencias_ms.append(ms)
+        return ms
+
+    def resumen_latencia(self) -> str:
+        if not self.latencias_ms:
+            return (f'sin lecturas registradas (respaldos a resolución completa: {self.respaldos}, '
+                    f'reconexiones: {self.reconexiones})')
+        orden = sorted(self.latencias_ms)
+        p50 = orden[len(orden) // 2]
+        p95 = orden[min(len(orden) - 1, int(len(orden) * 0.95))]
+        return (f'n={len(orden)} p50={p50:.1f}ms p95={p95:.1f}ms max={orden[-1]:.1f}ms '
+                f'respaldos={self.respaldos} reconexiones={self.reconexiones}')
 
-    cam.release()
-    cv2.destroyAllWindows()
-    return resultado
+def leer_qr_camera(timeout_seconds: int = 60, camera_index: int = 0):
+    """Lectura única: abre la cámara, espera un QR y la libera."""
+    with SesionEscaner(camera_index) as sesion:
+        texto, _ = sesion.leer(timeout_seconds)
+    return texto
 
 # ----------------- Verificación del texto del QR -----------------
 
@@ -182,6 +365,61 @@ def verificar_qr_text(qr_text: str, secret_key: bytes):
     except Exception as e:
         return False, None, f'formato_desconocido:{e}'
 
+# ----------------- Caché de lecturas recientes -----------------
+
+class CacheLecturas:
+    """
+    LRU acotada con TTL, indexada por el texto completo del QR (no solo por la
+    firma: un payload alterado con una firma copiada no debe encontrar entrada).
+    - Un texto visto hace menos de ventana_dedup segundos es una repetición
+      (la etiqueta sigue frente a la cámara) y se suprime.
+    - Un texto verificado hace menos de ttl segundos reutiliza el resultado
+      de verificar_qr_text sin recalcular el HMAC.
+    """
+
+    def __init__(self, capacidad: int = 4096, ttl: float = 300.0, ventana_dedup: float = 3.0):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self.ventana_dedup = ventana_dedup
+        self._datos = OrderedDict()  # texto -> [resultado, t_verificado, t_visto]
+        self.hits = 0
+        self.misses = 0
+        self.suprimidos = 0
+
+    def es_repetido(self, qr_text: str) -> bool:
+        """Marca qr_text como visto ahora; True si ya se vio dentro de la ventana."""
+        entrada = self._datos.get(qr_text)
+        if entrada is None:
+            return False
+        ahora = time.monotonic()
+        repetido = ahora - entrada[2] < self.ventana_dedup
+        entrada[2] = ahora
+        self._datos.move_to_end(qr_text)
+        if repetido:
+            self.suprimidos += 1
+        return repetido
+
+    def verificar(self, qr_text: str, secret_key: bytes):
+        """verificar_qr_text con caché; mismo retorno (ok, data, reason)."""
+        ahora = time.monotonic()
+        entrada = self._datos.get(qr_text)
+        if entrada is not None and ahora - entrada[1] < self.ttl:
+            self.hits += 1
+            entrada[2] = ahora
+            self._datos.move_to_end(qr_text)
+            return entrada[0]
+        self.misses += 1
+        resultado = verificar_qr_text(qr_text, secret_key)
+        self._datos[qr_text] = [resultado, ahora, ahora]
+        self._datos.move_to_end(qr_text)
+        while len(self._datos) > self.capacidad:
+            self._datos.popitem(last=False)
+        return resultado
+
+    def contadores(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'suprimidos': self.suprimidos,
+                'entradas': len(self._datos)}
+
 # ----------------- Datos simulados -----------------
 
 def generar_datos_simulados():
@@ -214,10 +452,21 @@ def inicializar_chain_si_no_existe():
             json.dump([genesis], f, indent=4, ensure_ascii=False)
         print('Blockchain inicializada con bloque genesis.')
 
-def agregar_bloque(data_str: str) -> dict:
+def cargar_chain() -> list:
     with open(CHAIN_FILE, 'r', encoding='utf-8') as f:
-        chain = json.load(f)
-    ultimo = chain[-1]
+        return json.load(f)
+
+def guardar_chain(chain: list, fsync: bool = False):
+    """Reescribe CHAIN_FILE de forma atómica (archivo temporal + os.replace)."""
+    tmp = CHAIN_FILE + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(chain, f, indent=4, ensure_ascii=False)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, CHAIN_FILE)
+
+def nuevo_bloque(ultimo: dict, data_str: str) -> dict:
     nuevo = {
         'index': ultimo['index'] + 1,
         'timestamp': datetime.utcnow().isoformat() + 'Z',
@@ -226,19 +475,357 @@ def agregar_bloque(data_str: str) -> dict:
         'hash': ''
     }
     nuevo['hash'] = calcular_hash(nuevo)
+    return nuevo
+
+def agregar_bloque(data_str: str) -> dict:
+    chain = cargar_chain()
+    nuevo = nuevo_bloque(chain[-1], data_str)
     chain.append(nuevo)
-    with open(CHAIN_FILE, 'w', encoding='utf-8') as f:
-        json.dump(chain, f, indent=4, ensure_ascii=False)
+    guardar_chain(chain)
+    actualizar_indice(chain)
     return nuevo
 
+# ----------------- Índices secundarios (SQLite) -----------------
+# El índice es derivado de chain.json: si se pierde o queda atrás se reconstruye
+# desde la última altura indexada. Cada evento es una fila (block_index, pos);
+# pos es la posición dentro de un lote Merkle o 0 en bloques de una lectura.
+
+def _abrir_indice(path: str = INDEX_FILE):
+    conn = sqlite3.connect(path)
+    columnas = ', '.join(f'{c} TEXT' for c in CAMPOS_INDICE)
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS eventos (
+        block_index INTEGER NOT NULL,
+        pos INTEGER NOT NULL,
+        ts TEXT,
+        {columnas},
+        registro TEXT NOT NULL,
+        PRIMARY KEY (block_index, pos))''')
+    tipos_meta = {fila[1]: fila[2] for fila in conn.execute('PRAGMA table_info(meta)')}
+    if tipos_meta.get('valor', 'TEXT') != 'TEXT':
+        # Índices viejos guardaban el hash en una columna INTEGER, que convierte
+        # un hash solo de dígitos en número: descartarlo y reindexar
+        conn.execute('DROP TABLE meta')
+        conn.execute('DELETE FROM eventos')
+        conn.commit()
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_eventos_ts ON eventos (ts)')
+    for c in CAMPOS_INDICE:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_eventos_{c} ON eventos ({c}, ts)')
+    return conn
+
+def _eventos_de_bloque(bloque: dict):
+    """Devuelve [(pos, registro_str, registro)] de un bloque simple o de lote."""
+    try:
+        data = json.loads(bloque.get('data', ''))
+    except ValueError:
+        return []  # GENESIS u otro texto libre
+    if not isinstance(data, dict):
+        return []
+    if data.get('tipo') == 'lote_merkle':
+        return [(pos, r, json.loads(r)) for pos, r in enumerate(data.get('registros', []))]
+    return [(0, bloque['data'], data)]
+
+def _valor_indice(valor):
+    """Texto o número tal cual; cualquier otro valor del payload (dict, lista, bool) como JSON."""
+    if valor is None or isinstance(valor, str):
+        return valor
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return valor
+    return json.dumps(valor, sort_keys=True, ensure_ascii=False)
+
+def _indexar_bloques(conn, bloques: list):
+    filas = []
+    for b in bloques:
+        for pos, registro_str, registro in _eventos_de_bloque(b):
+            payload = registro.get('qr_payload')
+            payload = payload if isinstance(payload, dict) else {}
+            ts = _valor_indice(registro.get('timestamp', b.get('timestamp')))
+            campos = [_valor_indice(payload.get(c)) for c in CAMPOS_INDICE]
+            filas.append((b['index'], pos, ts, *campos, registro_str))
+    marcas = ', '.join('?' * (3 + len(CAMPOS_INDICE) + 1))
+    conn.executemany(f'INSERT OR REPLACE INTO eventos VALUES ({marcas})', filas)
+    if bloques:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('altura', ?)", (bloques[-1]['index'],))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('hash', ?)", (bloques[-1]['hash'],))
+
+def actualizar_indice(chain: list, path: str = INDEX_FILE, desde_cero: bool = False) -> int:
+    """Indexa los bloques de chain posteriores a la última altura indexada; devuelve cuántos."""
+    try:
+        with closing(_abrir_indice(path)) as conn, conn:
+            if desde_cero:
+                conn.execute('DELETE FROM eventos')
+                conn.execute('DELETE FROM meta')
+            meta = dict(conn.execute('SELECT clave, valor FROM meta'))
+            altura = int(meta.get('altura', -1))
+            if altura >= 0 and (altura >= len(chain) or chain[altura]['hash'] != meta.get('hash')):
+                # El índice describe otra cadena (más larga o reemplazada): rehacerlo
+                conn.execute('DELETE FROM eventos')
+                conn.execute('DELETE FROM meta')
+                altura = -1
+            pendientes = chain[altura + 1:]
+            _indexar_bloques(conn, pendientes)
+            return len(pendientes)
+    except sqlite3.Error as e:
+        print('Aviso: no se pudo actualizar el índice:', e)
+        return 0
+
+def consultar_indice(filtros: dict = None, desde: str = None, hasta: str = None,
+                     limite: int = None, path: str = INDEX_FILE) -> list:
+    """
+    Busca eventos por igualdad en CAMPOS_INDICE y/o rango de timestamp ISO
+    (desde inclusivo, hasta exclusivo). Devuelve filas ordenadas por tiempo.
+    """
+    filtros = filtros or {}
+    condiciones, params = [], []
+    for campo, valor in filtros.items():
+        if campo not in CAMPOS_INDICE:
+            raise ValueError(f'Campo sin índice: {campo} (usa {", ".join(CAMPOS_INDICE)})')
+        condiciones.append(f'{campo} = ?')
+        params.append(valor)
+    if desde is not None:
+        condiciones.append('ts >= ?')
+        params.append(desde)
+    if hasta is not None:
+        condiciones.append('ts < ?')
+        params.append(hasta)
+    sql = 'SELECT block_index, pos, ts, registro FROM eventos'
+    if condiciones:
+        sql += ' WHERE ' + ' AND '.join(condiciones)
+    sql += ' ORDER BY ts, block_index, pos'
+    if limite is not None:
+        sql += ' LIMIT ?'
+        params.append(limite)
+    with closing(_abrir_indice(path)) as conn:
+        return [
+            {'block_index': bi, 'pos': pos, 'timestamp': ts, 'registro': json.loads(reg)}
+            for bi, pos, ts, reg in conn.execute(sql, params)
+        ]
+
+# ----------------- Lotes con árbol Merkle -----------------
+# Un bloque de lote guarda en 'data' los registros individuales y la raíz Merkle
+# de sus hashes. Hojas y nodos usan prefijos distintos (0x00 / 0x01) y un nodo
+# impar sube sin duplicarse, para que no haya dos árboles con la misma raíz.
+
+def merkle_hoja(registro_str: str) -> bytes:
+    return hashlib.sha256(b'\x00' + registro_str.encode('utf-8')).digest()
+
+def _merkle_nodo(izq: bytes, der: bytes) -> bytes:
+    return hashlib.sha256(b'\x01' + izq + der).digest()
+
+def _merkle_siguiente_nivel(nivel: list) -> list:
+    sig = [_merkle_nodo(nivel[i], nivel[i + 1]) for i in range(0, len(nivel) - 1, 2)]
+    if len(nivel) % 2:
+        sig.append(nivel[-1])
+    return sig
+
+def merkle_raiz(hojas: list) -> bytes:
+    if not hojas:
+        raise ValueError('Un lote Merkle necesita al menos una hoja')
+    nivel = list(hojas)
+    while len(nivel) > 1:
+        nivel = _merkle_siguiente_nivel(nivel)
+    return nivel[0]
+
+def merkle_prueba(hojas: list, pos: int) -> list:
+    """Camino de la hoja pos a la raíz: lista de [lado, hash_hex] del hermano."""
+    if not 0 <= pos < len(hojas):
+        raise IndexError(f'Posición {pos} fuera del lote ({len(hojas)} hojas)')
+    prueba = []
+    nivel = list(hojas)
+    while len(nivel) > 1:
+        hermano = pos ^ 1
+        if hermano < len(nivel):
+            prueba.append(['L' if hermano < pos else 'R', nivel[hermano].hex()])
+        nivel = _merkle_siguiente_nivel(nivel)
+        pos //= 2
+    return prueba
+
+def merkle_verificar(registro_str: str, prueba: list, raiz_hex: str) -> bool:
+    h = merkle_hoja(registro_str)
+    for lado, hermano_hex in prueba:
+        hermano = bytes.fromhex(hermano_hex)
+        h = _merkle_nodo(hermano, h) if lado == 'L' else _merkle_nodo(h, hermano)
+    return hmac.compare_digest(h.hex(), raiz_hex)
+
+def agregar_lote(registros: list) -> dict:
+    """Agrega un único bloque que compromete la raíz Merkle de los registros (texto JSON)."""
+    raiz = merkle_raiz([merkle_hoja(r) for r in registros])
+    data_str = json.dumps({
+        'tipo': 'lote_merkle',
+        'merkle_root': raiz.hex(),
+        'n': len(registros),
+        'registros': registros
+    }, sort_keys=True, ensure_ascii=False)
+    return agregar_bloque(data_str)
+
+def prueba_inclusion(index: int, pos: int) -> dict:
+    """Prueba de inclusión de la lectura pos del bloque de lote index."""
+    chain = cargar_chain()
+    if not 0 <= index < len(chain):
+        raise IndexError(f'No existe el bloque {index}')
+    bloque = chain[index]
+    try:
+        data = json.loads(bloque['data'])
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or data.get('tipo') != 'lote_merkle':
+        raise ValueError(f'El bloque {index} no es un lote Merkle')
+    registros = data['registros']
+    if not 0 <= pos < len(registros):
+        raise IndexError(f'Posición {pos} fuera del lote del bloque {index} ({len(registros)} lecturas)')
+    return {
+        'block_index': index,
+        'block_hash': bloque['hash'],
+        'merkle_root': data['merkle_root'],
+        'pos': pos,
+        'registro': registros[pos],
+        'prueba': merkle_prueba([merkle_hoja(r) for r in registros], pos)
+    }
+
+# ----------------- Verificación de la cadena -----------------
+
+def _verificar_segmento(bloques: list, desde: int = 0):
+    """Recalcula el hash de cada bloque; devuelve la primera posición rota o None."""
+    for pos, b in enumerate(bloques, start=desde):
+        if calcular_hash(b) != b.get('hash'):
+            return pos
+    return None
+
+def _firmar_checkpoint(altura: int, hash_bloque: str, secret_key: bytes) -> str:
+    msg = f"{altura}:{hash_bloque}".encode('utf-8')
+    return b64url_encode(hmac.new(secret_key, msg, hashlib.sha256).digest())
+
+def cargar_checkpoint(secret_key: bytes, chain: list, path: str = CHECKPOINT_FILE) -> int:
+    """
+    Devuelve la altura verificada del último checkpoint, o -1 si no existe,
+    su firma no es válida o ya no coincide con la cadena en disco.
+    """
+    if not os.path.exists(path):
+        return -1
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cp = json.load(f)
+        altura, hash_bloque = int(cp['height']), cp['hash']
+        firma = _firmar_checkpoint(altura, hash_bloque, secret_key)
+        if not hmac.compare_digest(firma, cp['sig']):
+            print('Checkpoint con firma inválida; se ignora.')
+            return -1
+    except Exception as e:
+        print('Checkpoint ilegible; se ignora:', e)
+        return -1
+    if altura >= len(chain) or chain[altura].get('hash') != hash_bloque:
+        print('El checkpoint no coincide con la cadena actual; se ignora.')
+        return -1
+    return altura
+
+def guardar_checkpoint(altura: int, hash_bloque: str, secret_key: bytes, path: str = CHECKPOINT_FILE):
+    cp = {
+        'height': altura,
+        'hash': hash_bloque,
+        'verified_at': datetime.utcnow().isoformat() + 'Z',
+        'sig': _firmar_checkpoint(altura, hash_bloque, secret_key)
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(cp, f, indent=4, ensure_ascii=False)
+
+def verificar_cadena(secret_key: bytes, workers: int = None, usar_checkpoint: bool = True,
+                     tam_min_segmento: int = 256):
+    """
+    Audita CHAIN_FILE: numeración, enlace prev_hash y hash de cada bloque.
+    Solo procesa los bloques posteriores al último checkpoint firmado (salvo
+    usar_checkpoint=False). Los hashes se recalculan por segmentos en paralelo.
+    Devuelve: (ok: bool, primer_index_roto: int or None, bloques_revisados: int)
+    """
+    chain = cargar_chain()
+
+    desde = cargar_checkpoint(secret_key, chain) + 1 if usar_checkpoint else 0
+    pendientes = chain[desde:]
+    rotos = []
+
+    # Numeración y enlace: comparaciones baratas, se hacen en este proceso
+    for pos, b in enumerate(pendientes, start=desde):
+        prev = chain[pos - 1]['hash'] if pos > 0 else '0'*64
+        if b.get('index') != pos or b.get('prev_hash') != prev:
+            rotos.append(pos)
+            break
+
+    # Recálculo de hashes: lo costoso, repartido en segmentos contiguos
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(pendientes) >= 2 * tam_min_segmento:
+        tam = max(tam_min_segmento, -(-len(pendientes) // workers))
+        offsets = list(range(0, len(pendientes), tam))
+        segmentos = [pendientes[i:i + tam] for i in offsets]
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            resultados = list(ex.map(_verificar_segmento, segmentos, [desde + i for i in offsets]))
+        rotos.extend(r for r in resultados if r is not None)
+    else:
+        r = _verificar_segmento(pendientes, desde)
+        if r is not None:
+            rotos.append(r)
+
+    primer_roto = min(rotos) if rotos else None
+    altura_ok = (primer_roto if primer_roto is not None else len(chain)) - 1
+    if altura_ok >= desde:
+        guardar_checkpoint(altura_ok, chain[altura_ok]['hash'], secret_key)
+    return primer_roto is None, primer_roto, len(pendientes)
+
 # ----------------- Flujo principal -----------------
 
+def construir_registro(data: dict, fuente=None, t_lectura: float = None) -> dict:
+    """
+    Registro del evento con la lectura de fuente (FuenteSensor; por defecto
+    FuenteSimulada) para t_lectura (time.time(), por defecto ahora), sin
+    esperar al sensor. La ubicación que la fuente no mida sigue siendo simulada.
+    """
+    if fuente is None:
+        fuente = FuenteSimulada(generar_datos_simulados)
+    registro = {
+        'qr_payload': data,
+        'timestamp': datetime.utcnow().isoformat() + 'Z'
+    }
+    registro.update(fuente.lectura(t_lectura))
+    if 'lat' not in registro:
+        _, _, registro['lat'], registro['lon'] = generar_datos_simulados()
+    return registro
+
+def anunciar_bloque(bloque: dict, secret_key: bytes):
+    print('\nBloque agregado a la blockchain simulada:')
+    print(json.dumps(bloque, indent=4, ensure_ascii=False))
+    print(f'Archivo de cadena: {os.path.abspath(CHAIN_FILE)}')
+
+    # Generar siguiente QR firmado que contiene el hash del bloque recién creado
+    nuevo_hash = bloque.get('hash')
+    nuevo_index = bloque.get('index')
+    qr_path, qr_text_next = generar_qr_next_from_hash(nuevo_hash, secret_key, nuevo_index)
+    print(f"\n➡️ Siguiente QR generado: {qr_path}")
+    print("Texto dentro del siguiente QR (para pruebas):")
+    print(qr_text_next)
+
 def main(argv=None):
     parser = argparse.ArgumentParser(description='QR -> datos simulados -> blockchain local (con QR siguiente firmado)')
     parser.add_argument('--generate-qrs', action='store_true', help='Generar qr_simple.png y qr_firmado.png')
     parser.add_argument('--timeout', type=int, default=60, help='Tiempo de espera para escanear el QR (s)')
     parser.add_argument('--secret', type=str, default=None, help='Clave HMAC en texto (reemplaza la default)')
     parser.add_argument('--camera', type=int, default=0, help='Indice de la camara (por defecto 0)')
+    parser.add_argument('--roi', type=str, default=None, help='Region X,Y,W,H del frame donde buscar el QR')
+    parser.add_argument('--scale', type=float, default=1.0, help='Factor de reduccion del frame antes de decodificar')
+    parser.add_argument('--multi', action='store_true', help='Procesar todos los QR de cada frame')
+    parser.add_argument('--dedup', type=float, default=3.0, help='Ventana (s) para suprimir lecturas repetidas')
+    parser.add_argument('--cache-ttl', type=float, default=300.0, help='Vigencia (s) de una verificacion en cache')
+    parser.add_argument('--cache-size', type=int, default=4096, help='Entradas maximas de la cache de lecturas')
+    parser.add_argument('--sensor', type=str, default='simulado', help='simulado, serial:PUERTO o replay:ARCHIVO')
+    parser.add_argument('--ubicacion', type=str, default=None, help='LAT,LON fijas del escaner')
+    parser.add_argument('--verify', action='store_true', help='Auditar la cadena y reportar el primer bloque roto')
+    parser.add_argument('--workers', type=int, default=None, help='Procesos para recalcular hashes (por defecto: nucleos)')
+    parser.add_argument('--full', action='store_true', help='Con --verify: ignorar el checkpoint y revisar toda la cadena')
+    parser.add_argument('--batch-size', type=int, default=1, help='Lecturas por bloque (lote Merkle si es > 1)')
+    parser.add_argument('--batch-window', type=float, default=5.0, help='Segundos maximos que un lote queda abierto')
+    parser.add_argument('--prove', type=int, nargs=2, metavar=('INDEX', 'POS'), help='Prueba de inclusion de una lectura de un lote')
+    parser.add_argument('--query', nargs='*', metavar='CAMPO=VALOR', help='Consultar eventos por sku/serial/batch/issuer')
+    parser.add_argument('--desde', type=str, default=None, help='Con --query: timestamp ISO minimo (inclusivo)')
+    parser.add_argument('--hasta', type=str, default=None, help='Con --query: timestamp ISO maximo (exclusivo)')
+    parser.add_argument('--limit', type=int, default=None, help='Con --query: numero maximo de resultados')
+    parser.add_argument('--reindex', action='store_true', help='Reconstruir el indice secundario desde la cadena')
     args = parser.parse_args(argv)
 
     secret_key = DEFAULT_SECRET if args.secret is None else args.secret.encode('utf-8')
@@ -247,55 +834,176 @@ def main(argv=None):
         generar_qr_ejemplos(secret_key)
         return
 
+    if args.verify:
+        if not os.path.exists(CHAIN_FILE):
+            parser.error(f'No existe {CHAIN_FILE} en {os.getcwd()}; no hay cadena que auditar')
+        inicio = time.perf_counter()
+        ok, roto, revisados = verificar_cadena(secret_key, workers=args.workers, usar_checkpoint=not args.full)
+        dt = time.perf_counter() - inicio
+        print(f'Bloques revisados: {revisados} en {dt:.3f}s')
+        if ok:
+            print('Cadena íntegra.')
+        else:
+            print(f'Cadena rota: primer bloque inválido en index {roto}')
+            sys.exit(1)
+        return
+
+    if args.prove:
+        if not os.path.exists(CHAIN_FILE):
+            parser.error(f'No existe {CHAIN_FILE} en {os.getcwd()}; no hay lotes que probar')
+        try:
+            prueba = prueba_inclusion(*args.prove)
+        except (ValueError, IndexError) as e:
+            parser.error(str(e))
+        print(json.dumps(prueba, indent=4, ensure_ascii=False))
+        ok = merkle_verificar(prueba['registro'], prueba['prueba'], prueba['merkle_root'])
+        print('Prueba de inclusión válida.' if ok else 'Prueba de inclusión INVÁLIDA.')
+        return
+
+    if args.reindex or args.query is not None:
+        inicializar_chain_si_no_existe()
+        chain = cargar_chain()
+        n = actualizar_indice(chain, desde_cero=args.reindex)
+        if args.reindex:
+            print(f'Índice reconstruido: {n} bloques en {os.path.abspath(INDEX_FILE)}')
+        if args.query is None:
+            return
+        try:
+            filtros = dict(par.split('=', 1) for par in args.query)
+        except ValueError:
+            parser.error('--query espera pares CAMPO=VALOR')
+        try:
+            resultados = consultar_indice(filtros, desde=args.desde, hasta=args.hasta, limite=args.limit)
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps(resultados, indent=4, ensure_ascii=False))
+        print(f'{len(resultados)} evento(s) encontrados.')
+        return
+
     # Ejecutar flujo de lectura
+    roi = None
+    if args.roi:
+        try:
+            roi = tuple(int(v) for v in args.roi.split(','))
+        except ValueError:
+            roi = ()
+        if len(roi) != 4 or roi[0] < 0 or roi[1] < 0 or roi[2] <= 0 or roi[3] <= 0:
+            parser.error('--roi espera X,Y,W,H en pixeles (X,Y >= 0; W,H > 0)')
+    if not 0 < args.scale <= 1:
+        parser.error('--scale debe estar en (0, 1]')
+    ubicacion = None
+    if args.ubicacion:
+        try:
+            ubicacion = parsear_ubicacion(args.ubicacion)
+        except ValueError:
+            parser.error('--ubicacion espera LAT,LON')
+    try:
+        fuente = crear_fuente(args.sensor, generar_datos_simulados, ubicacion=ubicacion)
+    except ValueError as e:
+        parser.error(str(e))
     inicializar_chain_si_no_existe()
-    while True:
-        print('\n--- Esperando QR (Ctrl+C para salir) ---')
-        qr_text = leer_qr_camera(timeout_seconds=args.timeout, camera_index=args.camera)
-        if qr_text is None:
-            print('No se leyó ningún QR. Intentar de nuevo...')
-            continue
-
-        ok, data, reason = verificar_qr_text(qr_text, secret_key)
-        if not ok:
-            print('QR no verificado:', reason)
-            print('No se registrará en la blockchain. Intenta con otro QR.')
-            continue
-
-        print('QR verificado. Motivo:', reason)
-
-        # Construir registro
-        registro = {
-            'qr_payload': data,
-            'timestamp': datetime.utcnow().isoformat() + 'Z'
-        }
-        temp, hum, lat, lon = generar_datos_simulados()
-        registro.update({
-            'temperatura_C': temp,
-            'humedad_%': hum,
-            'lat': lat,
-            'lon': lon
-        })
-
-        data_str = json.dumps(registro, sort_keys=True, ensure_ascii=False)
-        bloque = agregar_bloque(data_str)
-
-        print('\n--- Datos recopilados (simulados) ---')
-        print(json.dumps(registro, indent=4, ensure_ascii=False))
-        print('\nBloque agregado a la blockchain simulada:')
-        print(json.dumps(bloque, indent=4, ensure_ascii=False))
-        print(f'Archivo de cadena: {os.path.abspath(CHAIN_FILE)}')
-
-        # Generar siguiente QR firmado que contiene el hash del bloque recién creado
-        nuevo_hash = bloque.get('hash')
-        nuevo_index = bloque.get('index')
-        qr_path, qr_text_next = generar_qr_next_from_hash(nuevo_hash, secret_key, nuevo_index)
-        print(f"\n➡️ Siguiente QR generado: {qr_path}")
-        print("Texto dentro del siguiente QR (para pruebas):")
-        print(qr_text_next)
-
-        print('\nEscanea ahora el siguiente QR para continuar la cadena.')
-        # loop continuará esperando el siguiente QR y el sistema será reiterativo
+    sesion = SesionEscaner(args.camera, roi=roi, escala=args.scale)
+    if not sesion.abrir():
+        fuente.detener()
+        return
+    cache = CacheLecturas(capacidad=args.cache_size, ttl=args.cache_ttl, ventana_dedup=args.dedup)
+    lote = []  # registros (texto JSON) pendientes cuando --batch-size > 1
+    capturas = []  # t_captura de cada registro del lote, para la latencia
+    inicio_lote = 0.0
+    aviso_espera = True
+
+    def cerrar_lote():
+        nonlocal lote, capturas
+        bloque = agregar_lote(lote)
+        for t in capturas:
+            sesion.registrar_latencia(t)
+        print(f'\nLote de {len(lote)} lecturas cerrado.')
+        anunciar_bloque(bloque, secret_key)
+        print('Latencia escaneo->registro:', sesion.resumen_latencia())
+        print('Caché de lecturas:', cache.contadores())
+        print('Sensor:', fuente.metricas())
+        lote, capturas = [], []
+
+    try:
+        while True:
+            # Cerrar el lote si venció su ventana de tiempo
+            if lote and time.time() - inicio_lote >= args.batch_window:
+                cerrar_lote()
+
+            espera = args.timeout
+            if lote:
+                espera = max(0.1, min(espera, inicio_lote + args.batch_window - time.time()))
+
+            if aviso_espera:
+                print('\n--- Esperando QR (Ctrl+C para salir) ---')
+                aviso_espera = False
+            textos, t_captura = sesion.leer_todos(espera)
+            if not textos:
+                print('No se leyó ningún QR. Intentar de nuevo...')
+                aviso_espera = True
+                continue
+            # Una etiqueta que sigue frente a la cámara no se registra dos veces;
+            # se filtra antes de elegir, para no tapar a otra etiqueta del frame.
+            # dict.fromkeys quita además las copias del mismo código en este frame,
+            # que la caché aún no conoce
+            textos = [t for t in dict.fromkeys(textos) if not cache.es_repetido(t)]
+            if not args.multi:
+                textos = textos[:1]
+
+            for qr_text in textos:
+                aviso_espera = True
+                print('\nQR detectado:')
+                print(qr_text)
+
+                ok, data, reason = cache.verificar(qr_text, secret_key)
+                if not ok:
+                    print('QR no verificado:', reason)
+                    print('No se registrará en la blockchain. Intenta con otro QR.')
+                    continue
+
+                print('QR verificado. Motivo:', reason)
+
+                # Construir registro
+                # Lectura ambiental del instante del frame, no del fin de la verificación
+                t_lectura = time.time() - (time.perf_counter() - t_captura)
+                registro = construir_registro(data, fuente, t_lectura)
+                data_str = json.dumps(registro, sort_keys=True, ensure_ascii=False)
+
+                print(f'\n--- Datos recopilados ({args.sensor}) ---')
+                print(json.dumps(registro, indent=4, ensure_ascii=False))
+
+                if args.batch_size > 1:
+                    if not lote:
+                        inicio_lote = time.time()
+                    lote.append(data_str)
+                    capturas.append(t_captura)
+                    print(f'Lectura añadida al lote ({len(lote)}/{args.batch_size}).')
+                    if len(lote) >= args.batch_size:
+                        cerrar_lote()
+                    continue
+
+                bloque = agregar_bloque(data_str)
+                ms = sesion.registrar_latencia(t_captura)
+                anunciar_bloque(bloque, secret_key)
+                print(f'Latencia escaneo->registro: {ms:.1f}ms ({sesion.resumen_latencia()})')
+                print('Caché de lecturas:', cache.contadores())
+                print('Sensor:', fuente.metricas())
+
+                print('\nEscanea ahora el siguiente QR para continuar la cadena.')
+                # loop continuará esperando el siguiente QR y el sistema será reiterativo
+    except KeyboardInterrupt:
+        if lote:
+            bloque = agregar_lote(lote)
+            for t in capturas:
+                sesion.registrar_latencia(t)
+            print(f'\nLote pendiente de {len(lote)} lecturas guardado en el bloque {bloque["index"]}.')
+        raise
+    finally:
+        sesion.cerrar()
+        fuente.detener()
+        print('Sensor:', fuente.metricas())
+        print('Latencia escaneo->registro:', sesion.resumen_latencia())
+        print('Caché de lecturas:', cache.contadores())
 
 
 if __name__ == '__main__':
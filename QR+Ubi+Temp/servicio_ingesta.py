@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+servicio_ingesta.py
+
+Servicio local (asyncio, TCP en localhost) para que varios escáneres alimenten
+una sola blockchain (chain.json) a la vez, más un generador de carga para medir
+rendimiento y latencia.
+
+ - Cada cliente envía un texto QR por línea y recibe una línea JSON:
+     {"ok": true, "index": 42, "hash": "..."}  o  {"ok": false, "reason": "..."}
+ - verificar_qr_text se ejecuta en paralelo en un pool de procesos
+ - Un único escritor agrega los bloques: junta todo lo que llegó mientras
+   se guardaba el grupo anterior y lo confirma con un solo fsync (group commit)
+
+Uso:
+  - Servidor:
+      python3 servicio_ingesta.py servir [--port 8765] [--verify-workers N] [--max-group 256]
+                                         [--sensor serial:/dev/ttyUSB0] [--ubicacion LAT,LON]
+
+  - Generador de carga (QRs firmados con la misma clave):
+      python3 servicio_ingesta.py carga [--conexiones 50] [--n 5000]
+
+Notas:
+ - Mientras el servicio corre es el único que escribe chain.json; no ejecutar
+   a la vez el lector de qr_sim_blockchain.py sobre el mismo archivo.
+"""
+
+import sys
+import json
+import time
+import hmac
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from fuente_sensor import crear_fuente, parsear_ubicacion
+from qr_sim_blockchain import (
+    CHAIN_FILE, DEFAULT_SECRET, b64url_encode, verificar_qr_text, construir_registro, generar_datos_simulados,
+    inicializar_chain_si_no_existe, cargar_chain, guardar_chain, nuevo_bloque, actualizar_indice
+)
+
+# ----------------- Servidor -----------------
+
+class ServicioIngesta:
+    def __init__(self, secret_key: bytes, verify_workers: int = None, max_grupo: int = 256, fuente=None):
+        self.secret_key = secret_key
+        self.fuente = fuente
+        self.max_grupo = max_grupo
+        # verify_workers=0: verificar en el mismo proceso (útil para comparar)
+        self.pool = ProcessPoolExecutor(max_workers=verify_workers) if verify_workers != 0 else None
+        self.cola = asyncio.Queue()
+        self.chain = None
+        self.bloques = 0
+        self.commits = 0
+        self.rechazados = 0
+
+    async def _verificar(self, qr_text: str):
+        if self.pool is None:
+            return verificar_qr_text(qr_text, self.secret_key)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, verificar_qr_text, qr_text, self.secret_key)
+
+    def _persistir(self):
+        guardar_chain(self.chain, fsync=True)
+        actualizar_indice(self.chain)
+
+    async def _escritor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            grupo = [await self.cola.get()]
+            # Todo lo que llegó mientras se guardaba el grupo anterior entra en este
+            while len(grupo) < self.max_grupo:
+                try:
+                    grupo.append(self.cola.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            nuevos = []
+            for data_str, _ in grupo:
+                bloque = nuevo_bloque(self.chain[-1], data_str)
+                self.chain.append(bloque)
+                nuevos.append(bloque)
+            try:
+                # El escritor es el único que modifica self.chain, así que puede
+                # guardarse en otro hilo sin bloquear el loop
+                await loop.run_in_executor(None, self._persistir)
+            except Exception as e:
+                del self.chain[-len(nuevos):]
+                for _, fut in grupo:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.commits += 1
+            self.bloques += len(nuevos)
+            for (_, fut), bloque in zip(grupo, nuevos):
+                if not fut.done():
+                    fut.set_result(bloque)
+
+    async def registrar(self, qr_text: str) -> dict:
+        ok, data, reason = await self._verificar(qr_text)
+        if not ok:
+            self.rechazados += 1
+            return {'ok': False, 'reason': reason}
+        registro = construir_registro(data, self.fuente)
+        data_str = json.dumps(registro, sort_keys=True, ensure_ascii=False)
+        fut = asyncio.get_running_loop().create_future()
+        await self.cola.put((data_str, fut))
+        try:
+            bloque = await fut
+        except Exception as e:
+            return {'ok': False, 'reason': f'error_escritura:{e}'}
+        return {'ok': True, 'index': bloque['index'], 'hash': bloque['hash']}
+
+    async def _atender(self, reader, writer):
+        try:
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                qr_text = linea.decode('utf-8', errors='replace').strip()
+                if not qr_text:
+                    continue
+                respuesta = await self.registrar(qr_text)
+                writer.write((json.dumps(respuesta) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def resumen(self) -> str:
+        grupo = self.bloques / self.commits if self.commits else 0
+        texto = (f'bloques={self.bloques} commits={self.commits} '
+                 f'bloques/commit={grupo:.1f} rechazados={self.rechazados}')
+        if self.fuente is not None:
+            texto += f' sensor={self.fuente.metricas()}'
+        return texto
+
+    async def servir(self, host: str, port: int):
+        inicializar_chain_si_no_existe()
+        self.chain = cargar_chain()
+        escritor = asyncio.create_task(self._escritor())
+        server = await asyncio.start_server(self._atender, host, port)
+        print(f'Servicio de ingesta en {host}:{port} (cadena: {CHAIN_FILE}, altura {self.chain[-1]["index"]})')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            escritor.cancel()
+            if self.pool is not None:
+                self.pool.shutdown()
+            if self.fuente is not None:
+                self.fuente.detener()
+            print('\n' + self.resumen())
+
+# ----------------- Generador de carga -----------------
+
+def _qr_firmado(payload: dict, secret_key: bytes) -> str:
+    payload_json = json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    sig = hmac.new(secret_key, payload_json, hashlib.sha256).digest()
+    return f"{b64url_encode(payload_json)}.{b64url_encode(sig)}"
+
+async def _cliente_carga(host: str, port: int, textos: list, latencias: list, errores: list):
+    """Envía textos por una conexión; un corte solo termina este cliente, no toda la carga."""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        errores.append(f'conexion_fallida:{e}')
+        return
+    try:
+        for qr_text in textos:
+            t0 = time.perf_counter()
+            writer.write((qr_text + '\n').encode('utf-8'))
+            await writer.drain()
+            linea = await reader.readline()
+            if not linea:
+                raise ConnectionError('el servidor cerró la conexión')
+            respuesta = json.loads(linea)
+            latencias.append((time.perf_counter() - t0) * 1000)
+            if not respuesta.get('ok'):
+                errores.append(respuesta.get('reason'))
+    except ConnectionError as e:
+        errores.append(f'conexion_cerrada:{e}')
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def generar_carga(host: str, port: int, conexiones: int, n: int, secret_key: bytes):
+    etiqueta = int(time.time())
+    textos = [
+        _qr_firmado({'sku': 'CARGA', 'serial': f'{etiqueta}-{i:07d}', 'batch': 'carga',
+                     'issuer': 'servicio_ingesta'}, secret_key)
+        for i in range(n)
+    ]
+    repartos = [textos[i::conexiones] for i in range(conexiones)]
+    latencias, errores = [], []
+    inicio = time.perf_counter()
+    await asyncio.gather(*(_cliente_carga(host, port, r, latencias, errores) for r in repartos if r))
+    dt = time.perf_counter() - inicio
+
+    orden = sorted(latencias)
+    def pct(p):
+        return orden[min(len(orden) - 1, int(len(orden) * p))] if orden else 0
+    print(f'{len(latencias)} solicitudes en {dt:.2f}s con {conexiones} conexiones: {len(latencias) / dt:.0f} solicitudes/s')
+    print(f'Latencia: p50={pct(0.50):.1f}ms p95={pct(0.95):.1f}ms p99={pct(0.99):.1f}ms max={pct(1):.1f}ms')
+    if errores:
+        print(f'Errores: {len(errores)} (primero: {errores[0]})')
+
+# ----------------- CLI -----------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ingesta concurrente de QRs hacia la blockchain local')
+    parser.add_argument('modo', choices=['servir', 'carga'], help='servir: iniciar el servicio; carga: generar carga')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Direccion (por defecto solo localhost)')
+    parser.add_argument('--port', type=int, default=8765, help='Puerto TCP')
+    parser.add_argument('--secret', type=str, default=None, help='Clave HMAC en texto (reemplaza la default)')
+    parser.add_argument('--verify-workers', type=int, default=None, help='Procesos para verificar firmas (0: sin pool)')
+    parser.add_argument('--max-group', type=int, default=256, help='Bloques maximos por fsync')
+    parser.add_argument('--sensor', type=str, default='simulado', help='simulado, serial:PUERTO o replay:ARCHIVO')
+    parser.add_argument('--ubicacion', type=str, default=None, help='LAT,LON fijas del sitio (si no, se simulan)')
+    parser.add_argument('--conexiones', type=int, default=50, help='Carga: clientes simultaneos')
+    parser.add_argument('--n', type=int, default=5000, help='Carga: total de QRs a enviar')
+    args = parser.parse_args(argv)
+
+    secret_key = DEFAULT_SECRET if args.secret is None else args.secret.encode('utf-8')
+    if args.modo == 'servir':
+        ubicacion = None
+        if args.ubicacion:
+            try:
+                ubicacion = parsear_ubicacion(args.ubicacion)
+            except ValueError:
+                parser.error('--ubicacion espera LAT,LON')
+        try:
+            fuente = crear_fuente(args.sensor, generar_datos_simulados, ubicacion=ubicacion)
+        except ValueError as e:
+            parser.error(str(e))
+        servicio = ServicioIngesta(secret_key, verify_workers=args.verify_workers,
+                                   max_grupo=args.max_group, fuente=fuente)
+        asyncio.run(servicio.servir(args.host, args.port))
+    else:
+        asyncio.run(generar_carga(args.host, args.port, args.conexiones, args.n, secret_key))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('\nSaliendo...')
+        sys.exit(0)
@@ -0,0 +1,44 @@
+"""
+Pruebas del índice secundario de qr_sim_blockchain.py.
+
+Ejecutar desde esta carpeta:
+  python3 -m pytest -q test_indice.py
+"""
+
+import json
+
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('pyzbar')
+pytest.importorskip('qrcode')
+
+import qr_sim_blockchain as qsb
+
+
+def _registro(payload: dict) -> str:
+    return json.dumps({'qr_payload': payload, 'timestamp': '2025-11-05T10:00:00Z'}, sort_keys=True)
+
+
+def test_payload_no_escalar_no_detiene_el_indice(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    qsb.inicializar_chain_si_no_existe()
+
+    malo = qsb.agregar_bloque(_registro({'sku': {'x': 1}, 'serial': '9'}))
+    bueno = qsb.agregar_bloque(_registro({'sku': 'C', 'serial': '10'}))
+
+    resultados = qsb.consultar_indice({'sku': 'C'})
+    assert [r['block_index'] for r in resultados] == [bueno['index']]
+    # El valor no escalar queda guardado como JSON, también consultable
+    resultados = qsb.consultar_indice({'sku': '{"x": 1}'})
+    assert [r['block_index'] for r in resultados] == [malo['index']]
+
+
+def test_meta_guarda_el_hash_como_texto(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    qsb.inicializar_chain_si_no_existe()
+    chain = qsb.cargar_chain()
+    chain[0]['hash'] = '0' * 63 + '1'  # hash solo de dígitos
+    qsb.actualizar_indice(chain)
+
+    assert qsb.actualizar_indice(chain) == 0  # no se reindexa: el hash coincide